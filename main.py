@@ -1,13 +1,21 @@
 """Flow2API - Main Entry Point"""
+import importlib.util
 from src.main import app
 import uvicorn
 
 if __name__ == "__main__":
     from src.core.config import config
 
+    # uvloop/httptools 在 requirements.txt 中显式声明（Windows 上无 uvloop，回退 asyncio）
+    loop = "uvloop" if importlib.util.find_spec("uvloop") else "asyncio"
+    http = "httptools" if importlib.util.find_spec("httptools") else "h11"
+
     uvicorn.run(
         "src.main:app",
         host=config.server_host,
         port=config.server_port,
+        workers=config.server_workers,
+        loop=loop,
+        http=http,
         reload=False
     )
@@ -1,16 +1,18 @@
 """API routes - OpenAI compatible endpoints"""
 from fastapi import APIRouter, Depends, HTTPException
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import Response, StreamingResponse, JSONResponse
 from typing import List, Optional, Dict, Any, Tuple
+import asyncio
 import base64
+import bisect
 import re
-import json
 from urllib.parse import urlparse
 from curl_cffi.requests import AsyncSession
 from ..core.auth import verify_api_key_header
 from ..core.models import ChatCompletionRequest
 from ..services.generation_handler import GenerationHandler, MODEL_CONFIG
 from ..services.semantic_probe import SemanticProbeService
+from ..core.config import config
 from ..core.logger import debug_logger
 
 router = APIRouter()
@@ -18,26 +20,64 @@ router = APIRouter()
 generation_handler: GenerationHandler = None
 semantic_probe_service = SemanticProbeService()
 
+# 参考图下载复用同一个连接池（keep-alive），避免每张图都重新 DNS/TCP/TLS 握手
+_IMAGE_SESSION_MAX_CLIENTS = 16
+_image_session: Optional[AsyncSession] = None
+# 限制同时进行的远程图片下载，避免突发请求打满连接
+_IMAGE_DOWNLOAD_SEMAPHORE = asyncio.Semaphore(config.image_download_concurrency)
+# 历史参考图最多并发尝试最近 N 条 assistant 回复
+_HISTORY_IMAGE_SCAN_LIMIT = 3
+
+_SIZE_RE = re.compile(r"^\s*(\d{2,5})\s*[xX]\s*(\d{2,5})\s*$")
+_MD_IMG_RE = re.compile(r"!\[.*?\]\((.*?)\)")
+
+_REMOTE_PREFIXES = ("http://", "https://")
+_DATA_IMAGE_PREFIX = "data:image"
+
+# image_quality -> quality 映射
+_QUALITY_MAP: Dict[str, str] = {
+    "standard": "standard",
+    "normal": "standard",
+    "default": "standard",
+    "hd": "ultra",
+    "high": "ultra",
+    "ultra": "ultra",
+    "ultra-relaxed": "ultra_relaxed",
+    "relaxed": "ultra_relaxed"
+}
+
+# 模型 ID -> 类型（image/video）
+_MODEL_TYPE: Dict[str, str] = {model_id: cfg["type"] for model_id, cfg in MODEL_CONFIG.items()}
+
+# 宽高比推断表: (宽比, 高比, 名称)，容差 8%（|w/h - wr/hr| <= 8/100，整数交叉相乘判断）
+_ASPECT_TOLERANCE_PERCENT = 8
+_ASPECTS = (
+    (1, 1, "square"),
+    (4, 3, "four-three"),
+    (3, 4, "three-four"),
+)
+
+# 最长边阈值 -> 分辨率（bisect 查找）
+_RESOLUTION_THRESHOLDS = (1000, 1800, 3000)
+_RESOLUTION_LABELS = (None, "1080p", "2k", "4k")
+
 
 def _normalize_quality_from_image_quality(image_quality: Optional[str]) -> Optional[str]:
-    value = (image_quality or "").strip().lower().replace("_", "-")
-    mapping = {
-        "standard": "standard",
-        "normal": "standard",
-        "default": "standard",
-        "hd": "ultra",
-        "high": "ultra",
-        "ultra": "ultra",
-        "ultra-relaxed": "ultra_relaxed",
-        "relaxed": "ultra_relaxed"
-    }
-    return mapping.get(value)
+    return _QUALITY_MAP.get((image_quality or "").strip().lower().replace("_", "-"))
+
+
+def _decode_base64_data_url(data_url: str) -> Optional[bytes]:
+    """Decode the payload of a data:...;base64,<payload> URL (None if not base64)"""
+    _, sep, payload = data_url.partition("base64,")
+    if not sep or not payload:
+        return None
+    return base64.b64decode(payload)
 
 
 def _parse_size(size: Optional[str]) -> Tuple[Optional[int], Optional[int]]:
     if not size:
         return None, None
-    match = re.match(r"^\s*(\d{2,5})\s*[xX]\s*(\d{2,5})\s*$", size)
+    match = _SIZE_RE.match(size)
     if not match:
         return None, None
     return int(match.group(1)), int(match.group(2))
@@ -47,27 +87,16 @@ def _infer_aspect_ratio(width: Optional[int], height: Optional[int]) -> Optional
     if not width or not height or width <= 0 or height <= 0:
         return None
 
-    ratio = width / height
-    if abs(ratio - 1.0) <= 0.08:
-        return "square"
-    if abs(ratio - (4 / 3)) <= 0.08:
-        return "four-three"
-    if abs(ratio - (3 / 4)) <= 0.08:
-        return "three-four"
+    for ratio_w, ratio_h, name in _ASPECTS:
+        if abs(width * ratio_h - height * ratio_w) * 100 <= _ASPECT_TOLERANCE_PERCENT * height * ratio_h:
+            return name
     return "landscape" if width > height else "portrait"
 
 
 def _infer_resolution(width: Optional[int], height: Optional[int]) -> Optional[str]:
     if not width or not height or width <= 0 or height <= 0:
         return None
-    max_side = max(width, height)
-    if max_side >= 3000:
-        return "4k"
-    if max_side >= 1800:
-        return "2k"
-    if max_side >= 1000:
-        return "1080p"
-    return None
+    return _RESOLUTION_LABELS[bisect.bisect_right(_RESOLUTION_THRESHOLDS, max(width, height))]
 
 
 async def _resolve_generation_params(
@@ -96,16 +125,25 @@ async def _resolve_generation_params(
         "video_type": request.video_type
     }
 
-    # 2) 语意探查仅补全缺失字段
+    # 2) 语意探查仅补全缺失字段（显式/推导参数已覆盖全部字段时跳过；图片模型不需要 video_type）
+    needs_video_type = _MODEL_TYPE.get(request.model) != "image"
+    params_covered = (
+        current["aspect_ratio"] is not None
+        and current["resolution"] is not None
+        and current["quality"] is not None
+        and (current["video_type"] is not None or not needs_video_type)
+    )
+
     probed: Dict[str, Optional[str]] = {}
-    try:
-        probed = await semantic_probe_service.infer(
-            prompt=prompt,
-            has_images=has_images,
-            current=current
-        )
-    except Exception as e:
-        debug_logger.log_warning(f"[SEMANTIC_PROBE] 路由推断异常，继续本地逻辑: {str(e)}")
+    if not params_covered:
+        try:
+            probed = await semantic_probe_service.infer(
+                prompt=prompt,
+                has_images=has_images,
+                current=current
+            )
+        except Exception as e:
+            debug_logger.log_warning(f"[SEMANTIC_PROBE] 路由推断异常，继续本地逻辑: {str(e)}")
 
     final_aspect = request.aspect_ratio or derived_aspect or probed.get("aspect_ratio")
     final_resolution = request.resolution or derived_resolution or probed.get("resolution")
@@ -132,6 +170,28 @@ def set_generation_handler(handler: GenerationHandler):
     generation_handler = handler
 
 
+def _get_image_session() -> AsyncSession:
+    """Get shared image download session (created lazily on the running loop)"""
+    global _image_session
+    if _image_session is None:
+        _image_session = AsyncSession(
+            impersonate="chrome110",
+            verify=False,
+            timeout=30,
+            max_clients=_IMAGE_SESSION_MAX_CLIENTS
+        )
+    return _image_session
+
+
+async def close_image_session():
+    """Close shared image download session"""
+    global _image_session
+    if _image_session is not None:
+        session = _image_session
+        _image_session = None
+        await session.close()
+
+
 async def retrieve_image_data(url: str) -> Optional[bytes]:
     """
     智能获取图片数据：
@@ -145,38 +205,53 @@ async def retrieve_image_data(url: str) -> Optional[bytes]:
             filename = path.split("/tmp/")[-1]
             local_file_path = generation_handler.file_cache.cache_dir / filename
 
-            if local_file_path.exists() and local_file_path.is_file():
-                data = local_file_path.read_bytes()
+            if local_file_path.is_file():
+                data = await asyncio.to_thread(local_file_path.read_bytes)
                 if data:
                     return data
     except Exception as e:
         debug_logger.log_warning(f"[CONTEXT] 本地缓存读取失败: {str(e)}")
 
+    file_cache = generation_handler.file_cache if generation_handler else None
+
+    # 已下载过的远程图片直接命中本地 URL 缓存（多轮对话会反复引用同一张图）
+    if file_cache:
+        try:
+            data = await file_cache.get_url_bytes(url)
+            if data:
+                return data
+        except Exception as e:
+            debug_logger.log_warning(f"[CONTEXT] URL 缓存读取失败: {str(e)}")
+
     # 回退逻辑：网络下载
     try:
-        async with AsyncSession() as session:
-            response = await session.get(url, timeout=30, impersonate="chrome110", verify=False)
-            if response.status_code == 200:
-                return response.content
-            else:
-                debug_logger.log_warning(f"[CONTEXT] 图片下载失败，状态码: {response.status_code}")
+        async with _IMAGE_DOWNLOAD_SEMAPHORE:
+            response = await _get_image_session().get(url)
+        if response.status_code == 200:
+            data = response.content
+            if file_cache and data:
+                try:
+                    await file_cache.put_url_bytes(url, data)
+                except Exception as e:
+                    debug_logger.log_warning(f"[CONTEXT] URL 缓存写入失败: {str(e)}")
+            return data
+        else:
+            debug_logger.log_warning(f"[CONTEXT] 图片下载失败，状态码: {response.status_code}")
     except Exception as e:
         debug_logger.log_error(f"[CONTEXT] 图片下载异常: {str(e)}")
 
     return None
 
 
-@router.get("/v1/models")
-async def list_models(api_key: str = Depends(verify_api_key_header)):
-    """List available models"""
+def _build_models_response() -> Dict[str, Any]:
     models = []
 
-    for model_id, config in MODEL_CONFIG.items():
-        description = f"{config['type'].capitalize()} generation"
-        if config['type'] == 'image':
-            description += f" - {config['model_name']}"
+    for model_id, model_config in MODEL_CONFIG.items():
+        description = f"{model_config['type'].capitalize()} generation"
+        if model_config['type'] == 'image':
+            description += f" - {model_config['model_name']}"
         else:
-            description += f" - {config['model_key']}"
+            description += f" - {model_config['model_key']}"
 
         models.append({
             "id": model_id,
@@ -191,6 +266,16 @@ async def list_models(api_key: str = Depends(verify_api_key_header)):
     }
 
 
+# MODEL_CONFIG 是静态的，模型列表只需构建一次
+_MODELS_RESPONSE = _build_models_response()
+
+
+@router.get("/v1/models")
+async def list_models(api_key: str = Depends(verify_api_key_header)):
+    """List available models"""
+    return _MODELS_RESPONSE
+
+
 @router.post("/v1/chat/completions")
 async def create_chat_completion(
     request: ChatCompletionRequest,
@@ -214,39 +299,49 @@ async def create_chat_completion(
             prompt = content
         elif isinstance(content, list):
             # Multimodal format
+            # 先按原顺序占位，远程图片统一并发下载后再回填
+            image_slots: List[Optional[bytes]] = []
+            remote_urls: List[Tuple[int, str]] = []
             for item in content:
                 if item.get("type") == "text":
                     prompt = item.get("text", "")
                 elif item.get("type") == "image_url":
                     # Extract image from URL or base64
                     image_url = item.get("image_url", {}).get("url", "")
-                    if image_url.startswith("data:image"):
+                    if image_url.startswith(_DATA_IMAGE_PREFIX):
                         # Parse base64
-                        match = re.search(r"base64,(.+)", image_url)
-                        if match:
-                            image_base64 = match.group(1)
-                            image_bytes = base64.b64decode(image_base64)
-                            images.append(image_bytes)
-                    elif image_url.startswith("http://") or image_url.startswith("https://"):
+                        image_bytes = _decode_base64_data_url(image_url)
+                        if image_bytes is not None:
+                            image_slots.append(image_bytes)
+                    elif image_url.startswith(_REMOTE_PREFIXES):
                         # Download remote image URL
-                        debug_logger.log_info(f"[IMAGE_URL] 下载远程图片: {image_url}")
-                        try:
-                            downloaded_bytes = await retrieve_image_data(image_url)
-                            if downloaded_bytes and len(downloaded_bytes) > 0:
-                                images.append(downloaded_bytes)
-                                debug_logger.log_info(f"[IMAGE_URL] ✅ 远程图片下载成功: {len(downloaded_bytes)} 字节")
-                            else:
-                                debug_logger.log_warning(f"[IMAGE_URL] ⚠️ 远程图片下载失败或为空: {image_url}")
-                        except Exception as e:
-                            debug_logger.log_error(f"[IMAGE_URL] ❌ 远程图片下载异常: {str(e)}")
+                        if debug_logger.enabled:
+                            debug_logger.log_info(f"[IMAGE_URL] 下载远程图片: {image_url}")
+                        remote_urls.append((len(image_slots), image_url))
+                        image_slots.append(None)
+
+            if remote_urls:
+                results = await asyncio.gather(
+                    *(retrieve_image_data(url) for _, url in remote_urls),
+                    return_exceptions=True
+                )
+                for (slot, image_url), downloaded_bytes in zip(remote_urls, results):
+                    if isinstance(downloaded_bytes, BaseException):
+                        debug_logger.log_error(f"[IMAGE_URL] ❌ 远程图片下载异常: {str(downloaded_bytes)}")
+                    elif downloaded_bytes and len(downloaded_bytes) > 0:
+                        image_slots[slot] = downloaded_bytes
+                        if debug_logger.enabled:
+                            debug_logger.log_info(f"[IMAGE_URL] ✅ 远程图片下载成功: {len(downloaded_bytes)} 字节")
+                    else:
+                        debug_logger.log_warning(f"[IMAGE_URL] ⚠️ 远程图片下载失败或为空: {image_url}")
+
+            images = [image_bytes for image_bytes in image_slots if image_bytes]
 
         # Fallback to deprecated image parameter
         if request.image and not images:
-            if request.image.startswith("data:image"):
-                match = re.search(r"base64,(.+)", request.image)
-                if match:
-                    image_base64 = match.group(1)
-                    image_bytes = base64.b64decode(image_base64)
+            if request.image.startswith(_DATA_IMAGE_PREFIX):
+                image_bytes = _decode_base64_data_url(request.image)
+                if image_bytes is not None:
                     images.append(image_bytes)
 
         if not prompt:
@@ -260,43 +355,57 @@ async def create_chat_completion(
         )
 
         # 自动参考图：仅对图片模型生效（支持通用模型推断）
-        model_config = None
-        try:
-            _, model_config = generation_handler.resolve_model(
-                model=request.model,
-                images=images if images else None,
-                aspect_ratio=effective_params["aspect_ratio"],
-                resolution=effective_params["resolution"],
-                quality=effective_params["quality"],
-                video_type=effective_params["video_type"]
-            )
-        except Exception:
-            model_config = MODEL_CONFIG.get(request.model)
-
-        if model_config and model_config["type"] == "image" and len(request.messages) > 1:
-            debug_logger.log_info(f"[CONTEXT] 开始查找历史参考图，消息数量: {len(request.messages)}")
-
-            # 查找上一次 assistant 回复的图片
+        is_image_model = False
+        if len(request.messages) > 1:
+            model_type = _MODEL_TYPE.get(request.model)
+            if model_type is None:
+                # 非精确模型名时才需要通用模型推断
+                try:
+                    _, model_config = generation_handler.resolve_model(
+                        model=request.model,
+                        images=images if images else None,
+                        aspect_ratio=effective_params["aspect_ratio"],
+                        resolution=effective_params["resolution"],
+                        quality=effective_params["quality"],
+                        video_type=effective_params["video_type"]
+                    )
+                    model_type = model_config["type"]
+                except Exception:
+                    model_type = None
+            is_image_model = model_type == "image"
+
+        if is_image_model:
+            if debug_logger.enabled:
+                debug_logger.log_info(f"[CONTEXT] 开始查找历史参考图，消息数量: {len(request.messages)}")
+
+            # 查找 assistant 回复中的图片（由近到远），并发下载后取最近一张成功的
+            history_urls: List[str] = []
             for msg in reversed(request.messages[:-1]):
                 if msg.role == "assistant" and isinstance(msg.content, str):
                     # 匹配 Markdown 图片格式: ![...](http...)
-                    matches = re.findall(r"!\[.*?\]\((.*?)\)", msg.content)
-                    if matches:
-                        last_image_url = matches[-1]
-
-                        if last_image_url.startswith("http"):
-                            try:
-                                downloaded_bytes = await retrieve_image_data(last_image_url)
-                                if downloaded_bytes and len(downloaded_bytes) > 0:
-                                    # 将历史图片插入到最前面
-                                    images.insert(0, downloaded_bytes)
-                                    debug_logger.log_info(f"[CONTEXT] ✅ 添加历史参考图: {last_image_url}")
-                                    break
-                                else:
-                                    debug_logger.log_warning(f"[CONTEXT] 图片下载失败或为空，尝试下一个: {last_image_url}")
-                            except Exception as e:
-                                debug_logger.log_error(f"[CONTEXT] 处理参考图时出错: {str(e)}")
-                                # 继续尝试下一个图片
+                    matches = _MD_IMG_RE.findall(msg.content)
+                    if matches and matches[-1].startswith("http"):
+                        history_urls.append(matches[-1])
+                        if len(history_urls) >= _HISTORY_IMAGE_SCAN_LIMIT:
+                            break
+
+            if history_urls:
+                results = await asyncio.gather(
+                    *(retrieve_image_data(url) for url in history_urls),
+                    return_exceptions=True
+                )
+                for last_image_url, downloaded_bytes in zip(history_urls, results):
+                    if isinstance(downloaded_bytes, BaseException):
+                        debug_logger.log_error(f"[CONTEXT] 处理参考图时出错: {str(downloaded_bytes)}")
+                        # 继续尝试下一个图片
+                    elif downloaded_bytes and len(downloaded_bytes) > 0:
+                        # 将历史图片插入到最前面
+                        images.insert(0, downloaded_bytes)
+                        if debug_logger.enabled:
+                            debug_logger.log_info(f"[CONTEXT] ✅ 添加历史参考图: {last_image_url}")
+                        break
+                    else:
+                        debug_logger.log_warning(f"[CONTEXT] 图片下载失败或为空，尝试下一个: {last_image_url}")
 
         # Call generation handler
         if request.stream:
@@ -331,6 +440,7 @@ async def create_chat_completion(
             )
         else:
             # Non-streaming response
+            # handler 每次 yield 的都是完整 JSON 文档（出错时会在结果之后再 yield 错误响应），只取最后一个
             result = None
             async for chunk in generation_handler.handle_generation(
                 model=request.model,
@@ -348,13 +458,12 @@ async def create_chat_completion(
                 result = chunk
 
             if result:
-                # Parse the result JSON string
-                try:
-                    result_json = json.loads(result)
-                    return JSONResponse(content=result_json)
-                except json.JSONDecodeError:
-                    # If not JSON, return as-is
-                    return JSONResponse(content={"result": result})
+                body = result.encode("utf-8") if isinstance(result, str) else bytes(result)
+                # handler 已输出 JSON 字符串，直接透传避免一次解析+重新序列化
+                if body.lstrip().startswith((b"{", b"[")):
+                    return Response(content=body, media_type="application/json")
+                # If not JSON, return as-is
+                return JSONResponse(content={"result": body.decode("utf-8", errors="replace")})
             else:
                 raise HTTPException(status_code=500, detail="Generation failed: No response from handler")
 
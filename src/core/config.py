@@ -76,6 +76,16 @@ class Config:
     def server_port(self) -> int:
         return self._config["server"]["port"]
 
+    @property
+    def server_workers(self) -> int:
+        """Uvicorn worker process count.
+
+        Each worker holds its own token pool, concurrency counters and browser
+        captcha service, so only raise this when that state can be shared
+        (e.g. API-based captcha and no per-token concurrency limits).
+        """
+        return max(1, int(self._config["server"].get("workers", 1)))
+
     @property
     def debug_enabled(self) -> bool:
         return self._config.get("debug", {}).get("enabled", False)
@@ -156,6 +166,11 @@ class Config:
             self._config["generation"] = {}
         self._config["generation"]["upsample_timeout"] = timeout
 
+    @property
+    def image_download_concurrency(self) -> int:
+        """Get max concurrent reference image downloads per worker"""
+        return max(1, int(self._config.get("generation", {}).get("image_download_concurrency", 8)))
+
     # Semantic probe configuration
     @property
     def semantic_probe_enabled(self) -> bool:
@@ -182,6 +197,11 @@ class Config:
         """Get semantic probe request timeout in seconds"""
         return int(self._config.get("semantic_probe", {}).get("timeout", 15))
 
+    @property
+    def semantic_probe_deadline(self) -> float:
+        """Get max seconds a generation request waits for the semantic probe"""
+        return float(self._config.get("semantic_probe", {}).get("deadline", 3.0))
+
     def set_semantic_probe_enabled(self, enabled: bool):
         """Set semantic probe enabled status"""
         if "semantic_probe" not in self._config:
@@ -1,26 +1,75 @@
 """Debug logger module for detailed API request/response logging"""
+import atexit
 import json
 import logging
+import logging.handlers
+import queue
 from datetime import datetime
 from pathlib import Path
 from typing import Dict, Any, Optional
 from .config import config
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _dumps_pretty(data: Any) -> str:
+    """Pretty-print JSON for the log file (orjson when available)"""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(data, indent=2, ensure_ascii=False)
+
+
+def _loads(text: str) -> Any:
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+# 需要截断的大字段（通常是 base64 图片数据）
+_TRUNCATE_KEYS = frozenset(("encodedImage", "base64", "imageData", "data"))
+# 超过该长度的任意字符串也会被截断（可能是未知的 base64 字段）
+_LONG_STRING_LIMIT = 10000
+
+
+def _truncated_text(value: str) -> str:
+    return f"{value[:100]}... (truncated, total {len(value)} chars)"
+
+
+def _truncate_long_string(value: Any) -> Any:
+    if isinstance(value, str) and len(value) > _LONG_STRING_LIMIT:
+        return _truncated_text(value)
+    return value
+
+
 class DebugLogger:
     """Debug logger for API requests and responses"""
 
     def __init__(self):
         self.log_file = Path("logs.txt")
+        self._listener: Optional[logging.handlers.QueueListener] = None
         self._setup_logger()
+        atexit.register(self.stop)
+
+    @property
+    def enabled(self) -> bool:
+        """Whether debug logging is on (callers can skip building messages when False)"""
+        return config.debug_enabled
 
     def _setup_logger(self):
-        """Setup file logger"""
+        """Setup file logger
+
+        日志记录只入队，由后台 QueueListener 线程负责写文件，避免阻塞事件循环
+        """
         # Create logger
         self.logger = logging.getLogger("debug_logger")
         self.logger.setLevel(logging.DEBUG)
 
         # Remove existing handlers
         self.logger.handlers.clear()
+        self.stop()
 
         # Create file handler
         file_handler = logging.FileHandler(
@@ -37,12 +86,28 @@ class DebugLogger:
         )
         file_handler.setFormatter(formatter)
 
-        # Add handler
-        self.logger.addHandler(file_handler)
+        # Add queue handler, file writing happens on the listener thread
+        log_queue = queue.SimpleQueue()
+        self.logger.addHandler(logging.handlers.QueueHandler(log_queue))
+        self._listener = logging.handlers.QueueListener(
+            log_queue,
+            file_handler,
+            respect_handler_level=True
+        )
+        self._listener.start()
 
         # Prevent propagation to root logger
         self.logger.propagate = False
 
+    def stop(self):
+        """Flush queued records and stop the background writer"""
+        if self._listener is not None:
+            listener = self._listener
+            self._listener = None
+            listener.stop()
+            for handler in listener.handlers:
+                handler.close()
+
     def _mask_token(self, token: str) -> str:
         """Mask token for logging (show first 6 and last 6 characters)"""
         if not config.debug_mask_token or len(token) <= 12:
@@ -59,29 +124,47 @@ class DebugLogger:
 
     def _truncate_large_fields(self, data: Any, max_length: int = 200) -> Any:
         """对大字段进行截断处理，特别是 base64 编码的图片数据
-        
+
+        使用显式栈迭代遍历，避免深层嵌套时的递归开销
+
         Args:
             data: 要处理的数据
             max_length: 字符串字段的最大长度
-        
+
         Returns:
             截断后的数据副本
         """
-        if isinstance(data, dict):
-            result = {}
-            for key, value in data.items():
-                # 对特定的大字段进行截断
-                if key in ("encodedImage", "base64", "imageData", "data") and isinstance(value, str) and len(value) > max_length:
-                    result[key] = f"{value[:100]}... (truncated, total {len(value)} chars)"
-                else:
-                    result[key] = self._truncate_large_fields(value, max_length)
-            return result
-        elif isinstance(data, list):
-            return [self._truncate_large_fields(item, max_length) for item in data]
-        elif isinstance(data, str) and len(data) > 10000:
-            # 对超长字符串进行截断（可能是未知的 base64 字段）
-            return f"{data[:100]}... (truncated, total {len(data)} chars)"
-        return data
+        if not isinstance(data, (dict, list)):
+            return _truncate_long_string(data)
+
+        result: Any = {} if isinstance(data, dict) else []
+        stack = [(data, result)]
+        while stack:
+            source, target = stack.pop()
+            if isinstance(source, dict):
+                for key, value in source.items():
+                    # 对特定的大字段进行截断
+                    if key in _TRUNCATE_KEYS and isinstance(value, str) and len(value) > max_length:
+                        target[key] = _truncated_text(value)
+                    elif isinstance(value, dict):
+                        target[key] = {}
+                        stack.append((value, target[key]))
+                    elif isinstance(value, list):
+                        target[key] = []
+                        stack.append((value, target[key]))
+                    else:
+                        target[key] = _truncate_long_string(value)
+            else:
+                for item in source:
+                    if isinstance(item, dict):
+                        target.append({})
+                        stack.append((item, target[-1]))
+                    elif isinstance(item, list):
+                        target.append([])
+                        stack.append((item, target[-1]))
+                    else:
+                        target.append(_truncate_long_string(item))
+        return result
 
     def log_request(
         self,
@@ -132,7 +215,7 @@ class DebugLogger:
             if body is not None:
                 self.logger.info("\n📦 Request Body:")
                 if isinstance(body, (dict, list)):
-                    body_str = json.dumps(body, indent=2, ensure_ascii=False)
+                    body_str = _dumps_pretty(body)
                     self.logger.info(body_str)
                 else:
                     self.logger.info(str(body))
@@ -194,15 +277,15 @@ class DebugLogger:
             if isinstance(body, (dict, list)):
                 # 对大字段进行截断处理
                 body_to_log = self._truncate_large_fields(body)
-                body_str = json.dumps(body_to_log, indent=2, ensure_ascii=False)
+                body_str = _dumps_pretty(body_to_log)
                 self.logger.info(body_str)
             elif isinstance(body, str):
                 # Try to parse as JSON
                 try:
-                    parsed = json.loads(body)
+                    parsed = _loads(body)
                     # 对大字段进行截断处理
                     parsed = self._truncate_large_fields(parsed)
-                    body_str = json.dumps(parsed, indent=2, ensure_ascii=False)
+                    body_str = _dumps_pretty(parsed)
                     self.logger.info(body_str)
                 except:
                     # Not JSON, log as text (limit length)
@@ -244,8 +327,8 @@ class DebugLogger:
                 self.logger.info("\n📦 Error Response:")
                 # Try to parse as JSON
                 try:
-                    parsed = json.loads(response_text)
-                    body_str = json.dumps(parsed, indent=2, ensure_ascii=False)
+                    parsed = _loads(response_text)
+                    body_str = _dumps_pretty(parsed)
                     self.logger.info(body_str)
                 except:
                     # Not JSON, log as text
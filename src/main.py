@@ -160,6 +160,10 @@ async def lifespan(app: FastAPI):
     print("Flow2API Shutting down...")
     # Stop file cache cleanup task
     await generation_handler.file_cache.stop_cleanup_task()
+    # Close shared image download session
+    await routes.close_image_session()
+    # Close semantic probe Chat API session
+    await routes.semantic_probe_service.close()
     # Stop auto-unban task
     auto_unban_task_handle.cancel()
     try:
@@ -7,7 +7,6 @@ import asyncio
 import time
 import os
 import sys
-import subprocess
 from typing import Optional
 
 from ..core.logger import debug_logger
@@ -48,6 +47,8 @@ def _run_pip_install(package: str, use_mirror: bool = False) -> bool:
     Returns:
         是否安装成功
     """
+    import subprocess
+
     cmd = [sys.executable, '-m', 'pip', 'install', package]
     if use_mirror:
         cmd.extend(['-i', 'https://pypi.tuna.tsinghua.edu.cn/simple'])
@@ -2,40 +2,72 @@
 import os
 import asyncio
 import hashlib
+import itertools
 import time
+import uuid
 from pathlib import Path
-from typing import Optional
+from typing import Dict, Optional, Tuple
 from datetime import datetime, timedelta
 from curl_cffi.requests import AsyncSession
 from ..core.config import config
 from ..core.logger import debug_logger
 
 
+# Cached file extension per media type
+_EXT = {"video": ".mp4", "image": ".jpg"}
+
+# Safety-net sweep interval; files normally expire through their own scheduled task
+CLEANUP_INTERVAL = 3600
+# Directory entries handled per worker-thread hop during a sweep
+CLEANUP_BATCH_SIZE = 256
+# Streamed downloads are buffered to this size before each worker-thread write
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+
 class FileCache:
     """File caching service for videos"""
 
-    def __init__(self, cache_dir: str = "tmp", default_timeout: int = 7200, proxy_manager=None):
+    def __init__(self, cache_dir: str = "tmp", default_timeout: int = 7200, proxy_manager=None,
+                 url_cache_dir: Optional[str] = None):
         """
         Initialize file cache
 
         Args:
-            cache_dir: Cache directory path
+            cache_dir: Cache directory path (served publicly under /tmp)
             default_timeout: Default cache timeout in seconds (default: 2 hours)
             proxy_manager: ProxyManager instance for downloading files
+            url_cache_dir: Directory for raw upstream URL bytes; must not be served
+                (default: "<cache_dir>_url" next to cache_dir)
         """
         self.cache_dir = Path(cache_dir)
         self.cache_dir.mkdir(exist_ok=True)
+        self.url_cache_dir = Path(url_cache_dir) if url_cache_dir else self.cache_dir.with_name(f"{self.cache_dir.name}_url")
+        self.url_cache_dir.mkdir(exist_ok=True)
+        # Directories swept by cleanup/clear_all
+        self._cache_dirs = (self.cache_dir, self.url_cache_dir)
         self.default_timeout = default_timeout
         self.proxy_manager = proxy_manager
         self._cleanup_task = None
+        # Shared download session, created lazily on the running loop
+        self._session: Optional[AsyncSession] = None
+        # filename -> download task shared by concurrent callers
+        self._inflight: Dict[str, asyncio.Task] = {}
+        # filename -> task that deletes the file when it expires
+        self._expiry_tasks: Dict[Path, asyncio.Task] = {}
 
     async def start_cleanup_task(self):
         """Start background cleanup task"""
         if self._cleanup_task is None:
+            # Files left over from a previous run get their expiry scheduled from mtime
+            for file_path, mtime in await asyncio.to_thread(self._list_cached_files):
+                self._schedule_expiry(file_path, mtime + self.default_timeout - time.time())
             self._cleanup_task = asyncio.create_task(self._cleanup_loop())
 
     async def stop_cleanup_task(self):
         """Stop background cleanup task"""
+        for task in self._expiry_tasks.values():
+            task.cancel()
+        self._expiry_tasks.clear()
         if self._cleanup_task:
             self._cleanup_task.cancel()
             try:
@@ -43,12 +75,47 @@ class FileCache:
             except asyncio.CancelledError:
                 pass
             self._cleanup_task = None
+        if self._session is not None:
+            session = self._session
+            self._session = None
+            await session.close()
+
+    def _get_session(self) -> AsyncSession:
+        """Get the shared download session (keeps connections alive across downloads)"""
+        if self._session is None:
+            self._session = AsyncSession()
+        return self._session
+
+    def _list_cached_files(self) -> list:
+        files = []
+        for cache_dir in self._cache_dirs:
+            with os.scandir(cache_dir) as it:
+                files.extend((Path(entry.path), entry.stat().st_mtime) for entry in it if entry.is_file(follow_symlinks=False))
+        return files
+
+    def _schedule_expiry(self, file_path: Path, delay: float):
+        """Delete file_path after delay seconds (replaces any pending expiry for it)"""
+        previous = self._expiry_tasks.pop(file_path, None)
+        if previous is not None:
+            previous.cancel()
+        self._expiry_tasks[file_path] = asyncio.create_task(self._expire_later(file_path, max(0.0, delay)))
+
+    async def _expire_later(self, file_path: Path, delay: float):
+        try:
+            await asyncio.sleep(delay)
+            await asyncio.to_thread(file_path.unlink, missing_ok=True)
+        except asyncio.CancelledError:
+            return
+        except Exception as e:
+            debug_logger.log_warning(f"Failed to expire cache file {file_path.name}: {str(e)}")
+        if self._expiry_tasks.get(file_path) is asyncio.current_task():
+            del self._expiry_tasks[file_path]
 
     async def _cleanup_loop(self):
         """Background task to clean up expired files"""
         while True:
             try:
-                await asyncio.sleep(300)  # Check every 5 minutes
+                await asyncio.sleep(CLEANUP_INTERVAL)
                 await self._cleanup_expired_files()
             except asyncio.CancelledError:
                 break
@@ -59,22 +126,71 @@ class FileCache:
                     response_text=""
                 )
 
-    async def _cleanup_expired_files(self):
-        """Remove expired cache files"""
-        try:
-            current_time = time.time()
-            removed_count = 0
-
-            for file_path in self.cache_dir.iterdir():
-                if file_path.is_file():
-                    # Check file age
-                    file_age = current_time - file_path.stat().st_mtime
-                    if file_age > self.default_timeout:
+    def _remove_expired_batch(self, it, current_time: float) -> Tuple[int, bool]:
+        """Delete expired files among the next CLEANUP_BATCH_SIZE entries of a scandir iterator
+
+        Blocking, run in a worker thread. Returns (removed_count, exhausted).
+        """
+        removed_count = 0
+        seen = 0
+        # scandir reuses the directory read for is_file(), saving a stat per entry
+        for entry in itertools.islice(it, CLEANUP_BATCH_SIZE):
+            seen += 1
+            if not entry.is_file(follow_symlinks=False):
+                continue
+            # Check file age
+            file_age = current_time - entry.stat().st_mtime
+            if file_age > self.default_timeout:
+                try:
+                    os.unlink(entry.path)
+                    removed_count += 1
+                except OSError:
+                    pass
+
+        return removed_count, seen < CLEANUP_BATCH_SIZE
+
+    async def _remove_expired_files(self) -> int:
+        """Delete files older than the cache timeout, one batch per worker-thread hop
+
+        Returning to the event loop between batches lets stop_cleanup_task cancel a long sweep.
+        """
+        current_time = time.time()
+        removed_count = 0
+
+        for cache_dir in self._cache_dirs:
+            with os.scandir(cache_dir) as it:
+                while True:
+                    batch = asyncio.ensure_future(asyncio.to_thread(self._remove_expired_batch, it, current_time))
+                    try:
+                        removed, exhausted = await asyncio.shield(batch)
+                    except asyncio.CancelledError:
+                        # Let the running batch finish before the iterator is closed
+                        await asyncio.wait([batch])
+                        raise
+                    removed_count += removed
+                    if exhausted:
+                        break
+
+        return removed_count
+
+    def _remove_all_files(self) -> int:
+        """Delete every cached file (blocking, run in a worker thread)"""
+        removed_count = 0
+        for cache_dir in self._cache_dirs:
+            with os.scandir(cache_dir) as it:
+                for entry in it:
+                    if entry.is_file(follow_symlinks=False):
                         try:
-                            file_path.unlink()
+                            os.unlink(entry.path)
                             removed_count += 1
-                        except Exception:
+                        except OSError:
                             pass
+        return removed_count
+
+    async def _cleanup_expired_files(self):
+        """Remove expired cache files"""
+        try:
+            removed_count = await self._remove_expired_files()
 
             if removed_count > 0:
                 debug_logger.log_info(f"Cleanup: removed {removed_count} expired cache files")
@@ -88,18 +204,42 @@ class FileCache:
 
     def _generate_cache_filename(self, url: str, media_type: str) -> str:
         """Generate unique filename for cached file"""
-        # Use URL hash as filename
-        url_hash = hashlib.md5(url.encode()).hexdigest()
+        # Use URL hash as filename (not a security use, keeps working on FIPS builds)
+        url_hash = hashlib.md5(url.encode("utf-8"), usedforsecurity=False).hexdigest()
+        return f"{url_hash}{_EXT.get(media_type, '')}"
 
-        # Determine file extension
-        if media_type == "video":
-            ext = ".mp4"
-        elif media_type == "image":
-            ext = ".jpg"
-        else:
-            ext = ""
+    @staticmethod
+    def _tmp_path(file_path: Path) -> Path:
+        """Unique sibling path to write into before renaming onto file_path"""
+        return file_path.with_name(f"{file_path.name}.{os.getpid()}.{uuid.uuid4().hex[:8]}.tmp")
 
-        return f"{url_hash}{ext}"
+    async def _stream_to_file(self, response, file_path: Path) -> int:
+        """Write a streamed response body to disk chunk by chunk, returns the byte count
+
+        The body goes to a temporary file that is renamed onto file_path once complete,
+        so readers never see a truncated file. Network chunks are small, so they are
+        collected into WRITE_BUFFER_SIZE blocks to keep worker-thread hand-offs rare.
+        """
+        total = 0
+        tmp_path = self._tmp_path(file_path)
+        try:
+            f = await asyncio.to_thread(open, tmp_path, "wb")
+            try:
+                buffer = bytearray()
+                async for chunk in response.aiter_content():
+                    total += len(chunk)
+                    buffer += chunk
+                    if len(buffer) >= WRITE_BUFFER_SIZE:
+                        await asyncio.to_thread(f.write, bytes(buffer))
+                        buffer.clear()
+                if buffer:
+                    await asyncio.to_thread(f.write, bytes(buffer))
+            finally:
+                await asyncio.to_thread(f.close)
+            await asyncio.to_thread(os.replace, tmp_path, file_path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+        return total
 
     async def download_and_cache(self, url: str, media_type: str) -> str:
         """
@@ -115,6 +255,14 @@ class FileCache:
         filename = self._generate_cache_filename(url, media_type)
         file_path = self.cache_dir / filename
 
+        # Coalesce concurrent requests for the same file onto one download; checked before
+        # the cache lookup so a file that is still being written is never reported as a hit
+        task = self._inflight.get(filename)
+        if task is not None:
+            debug_logger.log_info(f"Waiting for in-flight download: {filename}")
+            # shield: one caller being cancelled must not abort the download for the others
+            return await asyncio.shield(task)
+
         # Check if already cached and not expired
         if file_path.exists():
             file_age = time.time() - file_path.stat().st_mtime
@@ -128,6 +276,14 @@ class FileCache:
                 except Exception:
                     pass
 
+        # No await since the in-flight lookup above, so registering here cannot race
+        task = asyncio.create_task(self._download(url, filename, file_path))
+        self._inflight[filename] = task
+        task.add_done_callback(lambda _: self._inflight.pop(filename, None))
+        return await asyncio.shield(task)
+
+    async def _download(self, url: str, filename: str, file_path: Path) -> str:
+        """Download url into file_path, trying curl_cffi, then wget, then curl"""
         # Download file
         debug_logger.log_info(f"Downloading file from: {url}")
 
@@ -140,46 +296,49 @@ class FileCache:
 
         # Try method 1: curl_cffi with browser impersonation
         try:
-            async with AsyncSession() as session:
-                proxies = {"http": proxy_url, "https": proxy_url} if proxy_url else None
-                headers = {
-                    "Accept": "*/*",
-                    "Accept-Language": "zh-CN,zh;q=0.9,en;q=0.8",
-                    "Accept-Encoding": "gzip, deflate, br",
-                    "Connection": "keep-alive",
-                    "Sec-Fetch-Dest": "document",
-                    "Sec-Fetch-Mode": "navigate",
-                    "Sec-Fetch-Site": "none",
-                    "Upgrade-Insecure-Requests": "1"
-                }
-                response = await session.get(
-                    url,
-                    timeout=60,
-                    proxies=proxies,
-                    headers=headers,
-                    impersonate="chrome120",
-                    verify=False
-                )
+            session = self._get_session()
+            proxies = {"http": proxy_url, "https": proxy_url} if proxy_url else None
+            headers = {
+                "Accept": "*/*",
+                "Accept-Language": "zh-CN,zh;q=0.9,en;q=0.8",
+                "Accept-Encoding": "gzip, deflate, br",
+                "Connection": "keep-alive",
+                "Sec-Fetch-Dest": "document",
+                "Sec-Fetch-Mode": "navigate",
+                "Sec-Fetch-Site": "none",
+                "Upgrade-Insecure-Requests": "1"
+            }
+            response = await session.get(
+                url,
+                timeout=60,
+                proxies=proxies,
+                headers=headers,
+                impersonate="chrome120",
+                verify=False,
+                stream=True
+            )
 
+            try:
                 if response.status_code == 200:
-                    with open(file_path, 'wb') as f:
-                        f.write(response.content)
-                    debug_logger.log_info(f"File cached (curl_cffi): {filename} ({len(response.content)} bytes)")
+                    total = await self._stream_to_file(response, file_path)
+                    self._schedule_expiry(file_path, self.default_timeout)
+                    debug_logger.log_info(f"File cached (curl_cffi): {filename} ({total} bytes)")
                     return filename
                 else:
                     debug_logger.log_warning(f"curl_cffi failed with HTTP {response.status_code}, trying wget...")
+            finally:
+                await response.aclose()
 
         except Exception as e:
             debug_logger.log_warning(f"curl_cffi failed: {str(e)}, trying wget...")
 
         # Try method 2: wget command
+        tmp_path = self._tmp_path(file_path)
         try:
-            import subprocess
-
             wget_cmd = [
                 "wget",
                 "-q",  # Quiet mode
-                "-O", str(file_path),  # Output file
+                "-O", str(tmp_path),  # Output file, renamed onto file_path when complete
                 "--timeout=60",
                 "--tries=3",
                 "--user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
@@ -201,33 +360,36 @@ class FileCache:
             wget_cmd.append(url)
 
             # Execute wget
-            result = subprocess.run(wget_cmd, capture_output=True, timeout=90, env=env)
+            returncode, stderr = await self._run_command(wget_cmd, env=env)
 
-            if result.returncode == 0 and file_path.exists():
-                file_size = file_path.stat().st_size
+            if returncode == 0 and tmp_path.exists():
+                file_size = tmp_path.stat().st_size
                 if file_size > 0:
+                    os.replace(tmp_path, file_path)
+                    self._schedule_expiry(file_path, self.default_timeout)
                     debug_logger.log_info(f"File cached (wget): {filename} ({file_size} bytes)")
                     return filename
                 else:
                     raise Exception("Downloaded file is empty")
             else:
-                error_msg = result.stderr.decode('utf-8', errors='ignore') if result.stderr else "Unknown error"
+                error_msg = stderr.decode('utf-8', errors='ignore') if stderr else "Unknown error"
                 debug_logger.log_warning(f"wget failed: {error_msg}, trying curl...")
 
         except FileNotFoundError:
             debug_logger.log_warning("wget not found, trying curl...")
         except Exception as e:
             debug_logger.log_warning(f"wget failed: {str(e)}, trying curl...")
+        finally:
+            tmp_path.unlink(missing_ok=True)
 
         # Try method 3: system curl command
+        tmp_path = self._tmp_path(file_path)
         try:
-            import subprocess
-
             curl_cmd = [
                 "curl",
                 "-L",  # Follow redirects
                 "-s",  # Silent mode
-                "-o", str(file_path),  # Output file
+                "-o", str(tmp_path),  # Output file, renamed onto file_path when complete
                 "--max-time", "60",
                 "-H", "Accept: */*",
                 "-H", "Accept-Language: zh-CN,zh;q=0.9,en;q=0.8",
@@ -243,17 +405,19 @@ class FileCache:
             curl_cmd.append(url)
 
             # Execute curl
-            result = subprocess.run(curl_cmd, capture_output=True, timeout=90)
+            returncode, stderr = await self._run_command(curl_cmd)
 
-            if result.returncode == 0 and file_path.exists():
-                file_size = file_path.stat().st_size
+            if returncode == 0 and tmp_path.exists():
+                file_size = tmp_path.stat().st_size
                 if file_size > 0:
+                    os.replace(tmp_path, file_path)
+                    self._schedule_expiry(file_path, self.default_timeout)
                     debug_logger.log_info(f"File cached (curl): {filename} ({file_size} bytes)")
                     return filename
                 else:
                     raise Exception("Downloaded file is empty")
             else:
-                error_msg = result.stderr.decode('utf-8', errors='ignore') if result.stderr else "Unknown error"
+                error_msg = stderr.decode('utf-8', errors='ignore') if stderr else "Unknown error"
                 raise Exception(f"curl command failed: {error_msg}")
 
         except Exception as e:
@@ -263,6 +427,31 @@ class FileCache:
                 response_text=str(e)
             )
             raise Exception(f"Failed to cache file: {str(e)}")
+        finally:
+            tmp_path.unlink(missing_ok=True)
+
+    async def _run_command(self, cmd: list, env: Optional[dict] = None, timeout: float = 90) -> Tuple[int, bytes]:
+        """Run a download command without blocking the event loop
+
+        Returns (returncode, stderr); the process is killed if it exceeds timeout.
+        """
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            env=env
+        )
+        try:
+            _, stderr = await asyncio.wait_for(proc.communicate(), timeout=timeout)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            raise Exception(f"{cmd[0]} timed out after {timeout} seconds")
+        except asyncio.CancelledError:
+            proc.kill()
+            await proc.wait()
+            raise
+        return proc.returncode, stderr
 
     async def cache_base64_image(self, base64_data: str, resolution: str = "") -> str:
         """
@@ -276,10 +465,9 @@ class FileCache:
             Local cache filename
         """
         import base64
-        import uuid
 
         # Generate unique filename
-        unique_id = hashlib.md5(f"{uuid.uuid4()}{time.time()}".encode()).hexdigest()
+        unique_id = hashlib.md5(f"{uuid.uuid4()}{time.time()}".encode(), usedforsecurity=False).hexdigest()
         suffix = f"_{resolution}" if resolution else ""
         filename = f"{unique_id}{suffix}.jpg"
         file_path = self.cache_dir / filename
@@ -287,8 +475,8 @@ class FileCache:
         try:
             # Decode base64 and save to file
             image_data = base64.b64decode(base64_data)
-            with open(file_path, 'wb') as f:
-                f.write(image_data)
+            await asyncio.to_thread(self._write_file_atomic, file_path, image_data)
+            self._schedule_expiry(file_path, self.default_timeout)
             debug_logger.log_info(f"Base64 image cached: {filename} ({len(image_data)} bytes)")
             return filename
         except Exception as e:
@@ -299,6 +487,41 @@ class FileCache:
             )
             raise Exception(f"Failed to cache base64 image: {str(e)}")
 
+    def _url_cache_path(self, url: str) -> Path:
+        """Content-addressed path for raw bytes downloaded from a URL
+
+        Kept in url_cache_dir rather than the served cache_dir, so upstream images
+        cannot be fetched over /tmp by anyone who guesses the name.
+        """
+        url_hash = hashlib.blake2b(url.encode(), digest_size=16).hexdigest()
+        return self.url_cache_dir / f"url_{url_hash}.bin"
+
+    def _read_fresh_file(self, file_path: Path) -> Optional[bytes]:
+        try:
+            if time.time() - file_path.stat().st_mtime >= self.default_timeout:
+                return None
+            return file_path.read_bytes() or None
+        except FileNotFoundError:
+            return None
+
+    def _write_file_atomic(self, file_path: Path, data: bytes):
+        tmp_path = self._tmp_path(file_path)
+        try:
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, file_path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+
+    async def get_url_bytes(self, url: str) -> Optional[bytes]:
+        """Read previously downloaded URL bytes from local cache (None on miss/expired)"""
+        return await asyncio.to_thread(self._read_fresh_file, self._url_cache_path(url))
+
+    async def put_url_bytes(self, url: str, data: bytes):
+        """Store downloaded URL bytes in local cache (deleted once the cache timeout passes)"""
+        file_path = self._url_cache_path(url)
+        await asyncio.to_thread(self._write_file_atomic, file_path, data)
+        self._schedule_expiry(file_path, self.default_timeout)
+
     def get_cache_path(self, filename: str) -> Path:
         """Get full path to cached file"""
         return self.cache_dir / filename
@@ -306,6 +529,15 @@ class FileCache:
     def set_timeout(self, timeout: int):
         """Set cache timeout in seconds"""
         self.default_timeout = timeout
+        # Reschedule pending expiries against the new timeout
+        now = time.time()
+        for file_path in list(self._expiry_tasks):
+            try:
+                mtime = file_path.stat().st_mtime
+            except FileNotFoundError:
+                self._expiry_tasks.pop(file_path).cancel()
+                continue
+            self._schedule_expiry(file_path, mtime + timeout - now)
         debug_logger.log_info(f"Cache timeout updated to {timeout} seconds")
 
     def get_timeout(self) -> int:
@@ -315,14 +547,10 @@ class FileCache:
     async def clear_all(self):
         """Clear all cached files"""
         try:
-            removed_count = 0
-            for file_path in self.cache_dir.iterdir():
-                if file_path.is_file():
-                    try:
-                        file_path.unlink()
-                        removed_count += 1
-                    except Exception:
-                        pass
+            for task in self._expiry_tasks.values():
+                task.cancel()
+            self._expiry_tasks.clear()
+            removed_count = await asyncio.to_thread(self._remove_all_files)
 
             debug_logger.log_info(f"Cache cleared: removed {removed_count} files")
             return removed_count
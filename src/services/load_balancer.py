@@ -1,10 +1,14 @@
 """Load balancing module for Flow2API"""
+import asyncio
 import random
 from typing import Optional, Dict, Any
 from ..core.models import Token
 from .concurrency_manager import ConcurrencyManager
 from ..core.logger import debug_logger
 
+# 每批并发检查的候选Token数量
+CHECK_BATCH_SIZE = 8
+
 
 class LoadBalancer:
     """Token load balancer with random selection"""
@@ -35,10 +39,14 @@ class LoadBalancer:
         Returns:
             Selected token or None if no available tokens
         """
-        debug_logger.log_info(f"[LOAD_BALANCER] 开始选择Token (图片生成={for_image_generation}, 视频生成={for_video_generation}, 模型={model})")
+        # 关闭调试日志时跳过日志字符串的格式化
+        log_enabled = debug_logger.enabled
+        if log_enabled:
+            debug_logger.log_info(f"[LOAD_BALANCER] 开始选择Token (图片生成={for_image_generation}, 视频生成={for_video_generation}, 模型={model})")
 
         active_tokens = await self.token_manager.get_active_tokens()
-        debug_logger.log_info(f"[LOAD_BALANCER] 获取到 {len(active_tokens)} 个活跃Token")
+        if log_enabled:
+            debug_logger.log_info(f"[LOAD_BALANCER] 获取到 {len(active_tokens)} 个活跃Token")
 
         self._last_filter_report = {
             "active_token_count": len(active_tokens),
@@ -54,58 +62,77 @@ class LoadBalancer:
             debug_logger.log_info(f"[LOAD_BALANCER] ❌ 没有活跃的Token")
             return None
 
-        # Filter tokens based on generation type
-        available_tokens = []
+        # 打乱顺序后返回第一个通过的Token（等价于随机选择，但无需检查全部Token）
+        indices = list(range(len(active_tokens)))
+        random.shuffle(indices)
         filtered_reasons = {}  # 记录过滤原因
 
-        for token in active_tokens:
-            # Check if token has valid AT (not expired)
-            if not await self.token_manager.is_at_valid(token.id):
-                filtered_reasons[token.id] = "AT无效或已过期"
-                continue
-
-            # Filter for image generation
-            if for_image_generation:
-                if not token.image_enabled:
-                    filtered_reasons[token.id] = "图片生成已禁用"
-                    continue
-
-                # Check concurrency limit
-                if self.concurrency_manager and not await self.concurrency_manager.can_use_image(token.id):
-                    filtered_reasons[token.id] = "图片并发已满"
-                    continue
-
-            # Filter for video generation
-            if for_video_generation:
-                if not token.video_enabled:
-                    filtered_reasons[token.id] = "视频生成已禁用"
-                    continue
-
-                # Check concurrency limit
-                if self.concurrency_manager and not await self.concurrency_manager.can_use_video(token.id):
-                    filtered_reasons[token.id] = "视频并发已满"
-                    continue
-
-            available_tokens.append(token)
+        # 先做无需等待的开关过滤
+        candidates = []
+        for index in indices:
+            token = active_tokens[index]
+            if for_image_generation and not token.image_enabled:
+                filtered_reasons[token.id] = "图片生成已禁用"
+            elif for_video_generation and not token.video_enabled:
+                filtered_reasons[token.id] = "视频生成已禁用"
+            else:
+                candidates.append(token)
+
+        # 按批并发检查 AT 和并发限制，批内按打乱后的顺序取第一个通过的Token
+        selected = None
+        for start in range(0, len(candidates), CHECK_BATCH_SIZE):
+            batch = candidates[start:start + CHECK_BATCH_SIZE]
+            reasons = await asyncio.gather(*(
+                self._check_token(token, for_image_generation, for_video_generation)
+                for token in batch
+            ))
+            for token, reason in zip(batch, reasons):
+                if reason is None:
+                    selected = token
+                    break
+                filtered_reasons[token.id] = reason
+            if selected is not None:
+                break
 
         # 输出过滤信息
-        if filtered_reasons:
+        if filtered_reasons and log_enabled:
             debug_logger.log_info(f"[LOAD_BALANCER] 已过滤Token:")
             for token_id, reason in filtered_reasons.items():
                 debug_logger.log_info(f"[LOAD_BALANCER]   - Token {token_id}: {reason}")
 
-        self._last_filter_report["filtered_reasons"] = {str(k): v for k, v in filtered_reasons.items()}
-
-        if not available_tokens:
+        if selected is None:
+            # 所有Token都已检查过，过滤原因是完整的，供生成失败时诊断
+            self._last_filter_report["filtered_reasons"] = {str(k): v for k, v in filtered_reasons.items()}
             self._last_filter_report["summary"] = "NO_AVAILABLE_TOKENS"
-            debug_logger.log_info(f"[LOAD_BALANCER] ❌ 没有可用的Token (图片生成={for_image_generation}, 视频生成={for_video_generation})")
+            if log_enabled:
+                debug_logger.log_info(f"[LOAD_BALANCER] ❌ 没有可用的Token (图片生成={for_image_generation}, 视频生成={for_video_generation})")
             return None
 
+        if log_enabled:
+            self._last_filter_report["filtered_reasons"] = {str(k): v for k, v in filtered_reasons.items()}
         self._last_filter_report["summary"] = "TOKEN_SELECTED"
-        self._last_filter_report["available_token_ids"] = [token.id for token in available_tokens]
-
-        # Random selection
-        selected = random.choice(available_tokens)
+        self._last_filter_report["available_token_ids"] = [selected.id]
         self._last_filter_report["selected_token_id"] = selected.id
-        debug_logger.log_info(f"[LOAD_BALANCER] ✅ 已选择Token {selected.id} ({selected.email}) - 余额: {selected.credits}")
+        if log_enabled:
+            debug_logger.log_info(f"[LOAD_BALANCER] ✅ 已选择Token {selected.id} ({selected.email}) - 余额: {selected.credits}")
         return selected
+
+    async def _check_token(
+        self,
+        token: Token,
+        for_image_generation: bool,
+        for_video_generation: bool
+    ) -> Optional[str]:
+        """检查单个Token是否可用，返回过滤原因；可用时返回 None"""
+        # Check if token has valid AT (not expired)
+        if not await self.token_manager.is_at_valid(token.id):
+            return "AT无效或已过期"
+
+        # Check concurrency limit
+        if self.concurrency_manager:
+            if for_image_generation and not await self.concurrency_manager.can_use_image(token.id):
+                return "图片并发已满"
+            if for_video_generation and not await self.concurrency_manager.can_use_video(token.id):
+                return "视频并发已满"
+
+        return None
@@ -1,17 +1,24 @@
 """Proxy management module"""
+import time
 from typing import Optional
 from ..core.database import Database
 from ..core.models import ProxyConfig
 
+# Seconds a proxy config read from the database stays valid in memory
+PROXY_CONFIG_TTL = 30.0
+
+
 class ProxyManager:
     """Proxy configuration manager"""
 
     def __init__(self, db: Database):
         self.db = db
+        self._cached: Optional[ProxyConfig] = None
+        self._cache_ts = 0.0
 
     async def get_proxy_url(self) -> Optional[str]:
         """Get proxy URL if enabled, otherwise return None"""
-        config = await self.db.get_proxy_config()
+        config = await self.get_proxy_config()
         if config and config.enabled and config.proxy_url:
             return config.proxy_url
         return None
@@ -19,7 +26,12 @@ class ProxyManager:
     async def update_proxy_config(self, enabled: bool, proxy_url: Optional[str]):
         """Update proxy configuration"""
         await self.db.update_proxy_config(enabled, proxy_url)
+        self._cached = None
 
     async def get_proxy_config(self) -> ProxyConfig:
-        """Get proxy configuration"""
-        return await self.db.get_proxy_config()
+        """Get proxy configuration (cached for PROXY_CONFIG_TTL seconds)"""
+        now = time.monotonic()
+        if self._cached is None or now - self._cache_ts > PROXY_CONFIG_TTL:
+            self._cached = await self.db.get_proxy_config()
+            self._cache_ts = now
+        return self._cached
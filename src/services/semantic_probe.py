@@ -1,16 +1,109 @@
 """Semantic probe service for auto-inferring generation parameters via configurable Chat API."""
+import asyncio
 import json
 import re
-from typing import Optional, Dict, Any
+import time
+from collections import OrderedDict
+from typing import Optional, Dict, Any, Tuple
 from curl_cffi.requests import AsyncSession
 
 from ..core.config import config
 from ..core.logger import debug_logger
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _loads(text) -> Any:
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+def _dumps(data: Any) -> str:
+    if orjson is not None:
+        return orjson.dumps(data).decode()
+    return json.dumps(data, ensure_ascii=False)
+
+
+# 探查结果缓存（相同 prompt 的突发请求不再重复调用外部 Chat API）
+_CACHE_MAX_SIZE = 4096
+_CACHE_TTL_SECONDS = 300.0
+
+_PROBE_FIELDS = ("aspect_ratio", "resolution", "quality", "video_type")
+
+# 从模型回复中提取 ```json 代码块的正则
+_JSON_FENCE_RE = re.compile(r"```json\s*(\{[\s\S]*?\})\s*```", re.IGNORECASE)
+
+
+def _find_first_json_object(text: str) -> Optional[str]:
+    """按括号深度单次扫描，返回文本中第一个完整的 {...} 片段（跳过字符串内的括号）"""
+    start = text.find("{")
+    if start < 0:
+        return None
+
+    depth = 0
+    in_str = False
+    escaped = False
+    for i in range(start, len(text)):
+        c = text[i]
+        if in_str:
+            if escaped:
+                escaped = False
+            elif c == "\\":
+                escaped = True
+            elif c == '"':
+                in_str = False
+        elif c == '"':
+            in_str = True
+        elif c == "{":
+            depth += 1
+        elif c == "}":
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return None
+
 
 class SemanticProbeService:
     """Use external Chat API to infer aspect_ratio/resolution/video_type/quality from prompt."""
 
+    def __init__(self):
+        self._cache: "OrderedDict[Tuple, Tuple[float, Dict[str, Optional[str]]]]" = OrderedDict()
+        # 复用连接的 Chat API 会话（首次探查时在当前事件循环中创建）
+        self._session: Optional[AsyncSession] = None
+
+    def _get_session(self) -> AsyncSession:
+        if self._session is None:
+            self._session = AsyncSession()
+        return self._session
+
+    async def close(self):
+        """Close the shared Chat API session"""
+        if self._session is not None:
+            session = self._session
+            self._session = None
+            await session.close()
+
+    def _cache_get(self, key: Tuple) -> Optional[Dict[str, Optional[str]]]:
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if time.monotonic() >= expires_at:
+            self._cache.pop(key, None)
+            return None
+        self._cache.move_to_end(key)
+        return dict(value)
+
+    def _cache_set(self, key: Tuple, value: Dict[str, Optional[str]]):
+        self._cache[key] = (time.monotonic() + _CACHE_TTL_SECONDS, dict(value))
+        self._cache.move_to_end(key)
+        while len(self._cache) > _CACHE_MAX_SIZE:
+            self._cache.popitem(last=False)
+
     @staticmethod
     def _extract_json(text: str) -> Optional[Dict[str, Any]]:
         if not text:
@@ -18,27 +111,27 @@ class SemanticProbeService:
 
         # Try direct JSON first
         try:
-            data = json.loads(text)
+            data = _loads(text)
             if isinstance(data, dict):
                 return data
         except Exception:
             pass
 
         # Try fenced JSON block
-        match = re.search(r"```json\s*(\{[\s\S]*?\})\s*```", text, re.IGNORECASE)
+        match = _JSON_FENCE_RE.search(text)
         if match:
             try:
-                data = json.loads(match.group(1))
+                data = _loads(match.group(1))
                 if isinstance(data, dict):
                     return data
             except Exception:
                 pass
 
         # Try first object in text
-        match = re.search(r"(\{[\s\S]*\})", text)
-        if match:
+        candidate = _find_first_json_object(text)
+        if candidate:
             try:
-                data = json.loads(match.group(1))
+                data = _loads(candidate)
                 if isinstance(data, dict):
                     return data
             except Exception:
@@ -56,6 +149,10 @@ class SemanticProbeService:
         if not config.semantic_probe_enabled:
             return {}
 
+        # 所有字段都已确定时无需探查
+        if all(current.get(field) is not None for field in _PROBE_FIELDS):
+            return {}
+
         api_url = config.semantic_probe_api_url
         api_key = config.semantic_probe_api_key
         model = config.semantic_probe_model
@@ -63,6 +160,47 @@ class SemanticProbeService:
         if not api_url or not model:
             return {}
 
+        cache_key = (
+            api_url,
+            model,
+            prompt,
+            has_images,
+            tuple(current.get(field) for field in _PROBE_FIELDS)
+        )
+        cached = self._cache_get(cache_key)
+        if cached is not None:
+            return cached
+
+        # timeout 是 HTTP 请求自身的超时；deadline 是生成请求最多等待探查的时长（探查只是辅助推断）
+        timeout = config.semantic_probe_timeout
+        deadline = config.semantic_probe_deadline
+        try:
+            result = await asyncio.wait_for(
+                self._request_probe(api_url, api_key, model, prompt, has_images, current, timeout),
+                timeout=deadline
+            )
+        except asyncio.TimeoutError:
+            debug_logger.log_runtime_warning(
+                f"[SEMANTIC_PROBE] 探查超过等待上限 semantic_probe.deadline={deadline}s "
+                f"(HTTP timeout={timeout}s)，已回退本地逻辑"
+            )
+            return {}
+
+        if result:
+            self._cache_set(cache_key, result)
+        return result
+
+    async def _request_probe(
+        self,
+        api_url: str,
+        api_key: str,
+        model: str,
+        prompt: str,
+        has_images: bool,
+        current: Dict[str, Optional[str]],
+        timeout: int
+    ) -> Dict[str, Optional[str]]:
+        """Call the configured Chat API once and parse its JSON answer."""
         system_prompt = (
             "你是参数推断器。请根据用户生成意图输出JSON，字段仅包含："
             "aspect_ratio,resolution,quality,video_type。\n"
@@ -84,7 +222,7 @@ class SemanticProbeService:
             "model": model,
             "messages": [
                 {"role": "system", "content": system_prompt},
-                {"role": "user", "content": json.dumps(user_prompt, ensure_ascii=False)}
+                {"role": "user", "content": _dumps(user_prompt)}
             ],
             "temperature": 0,
             "stream": False
@@ -95,36 +233,36 @@ class SemanticProbeService:
             headers["Authorization"] = f"Bearer {api_key}"
 
         try:
-            async with AsyncSession() as session:
-                resp = await session.post(
-                    api_url,
-                    headers=headers,
-                    json=payload,
-                    timeout=config.semantic_probe_timeout,
-                    impersonate="chrome110"
-                )
-
-                if resp.status_code >= 400:
-                    debug_logger.log_warning(f"[SEMANTIC_PROBE] HTTP {resp.status_code}: {resp.text[:300]}")
-                    return {}
-
-                result = resp.json()
-                content = (
-                    result.get("choices", [{}])[0]
-                    .get("message", {})
-                    .get("content", "")
-                )
-
-                data = self._extract_json(content)
-                if not data:
-                    return {}
-
-                return {
-                    "aspect_ratio": data.get("aspect_ratio"),
-                    "resolution": data.get("resolution"),
-                    "quality": data.get("quality"),
-                    "video_type": data.get("video_type")
-                }
+            session = self._get_session()
+            resp = await session.post(
+                api_url,
+                headers=headers,
+                json=payload,
+                timeout=timeout,
+                impersonate="chrome110"
+            )
+
+            if resp.status_code >= 400:
+                debug_logger.log_warning(f"[SEMANTIC_PROBE] HTTP {resp.status_code}: {resp.text[:300]}")
+                return {}
+
+            result = _loads(resp.content)
+            content = (
+                result.get("choices", [{}])[0]
+                .get("message", {})
+                .get("content", "")
+            )
+
+            data = self._extract_json(content)
+            if not data:
+                return {}
+
+            return {
+                "aspect_ratio": data.get("aspect_ratio"),
+                "resolution": data.get("resolution"),
+                "quality": data.get("quality"),
+                "video_type": data.get("video_type")
+            }
         except Exception as e:
             debug_logger.log_warning(f"[SEMANTIC_PROBE] 推断失败，已回退本地逻辑: {str(e)}")
             return {}